@@ -1,21 +1,43 @@
 import streamlit as st
-import pandas as pd
 import google.generativeai as genai
 import gspread
 import json
 import uuid
-from datetime import datetime
+import re
+import math
+import random
+import time
+import difflib
+import hashlib
+import atexit
+import queue
+import sqlite3
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from google.api_core.exceptions import DeadlineExceeded
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import GoogleAuthError
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 
-# --- CONFIGURATION ---
-# 1. Your existing Master Schedule URL (The Map)
-MASTER_SHEET_URL = "https://docs.google.com/spreadsheets/d/1azbcaaIgw7K_MGZJfYdaX4mTvsYBx48ApdQ0HM8mNdA/edit"
-LINKS_TAB_NAME = "AI_LINKS"
-MEMORY_SHEET_URL = "https://docs.google.com/spreadsheets/d/1DDxAADCvTUcvKdeTb76giFBLIa3Yb1XOeGievJ_cung/edit"
-STOCK_SHEET_URL = "https://docs.google.com/spreadsheets/d/1E2GQfGkxkdbz0RmbbPcaIrMzmkJLC3MlNbGr4FT6FvM/edit?gid=2110353921#gid=2110353921"
-
-LOGS_TAB_NAME = "CHAT_LOGS"
-REF_DATA_TAB_NAME = "Ref_Data"
+from config import (
+    MASTER_SHEET_URL, LINKS_TAB_NAME, MEMORY_SHEET_URL, STOCK_SHEET_URL, LOGS_TAB_NAME,
+    REF_DATA_TAB_NAME, GEMINI_MODEL_NAME, EMBEDDING_MODEL, GENERATION_CONFIG, MEMORY_DB_PATH,
+    SYNC_BATCH_ROWS, SYNC_INTERVAL_SECONDS, SYNC_MAX_PENDING_ROWS, SYNC_QUEUE_SIZE, SIDEBAR_SESSION_LIMIT,
+    HISTORY_RENDER_LIMIT, CONTEXT_MESSAGES, MAP_CACHE_TTL, TASKS_CACHE_TTL, SHEET_CACHE_TTL,
+    TAB_TITLES_CACHE_TTL, SESSIONS_CACHE_TTL, READ_WORKERS,
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MIN_KEYWORDS,
+    FUZZY_MATCH_CUTOFF, PREFETCH_TTL_SECONDS, PREFETCH_TOP_K, ROUTE_HISTORY_SIZE,
+    CONFIDENT_ROUTE_SCORE, TASK_ROUTE_KEYWORDS, STOCK_ROUTE_KEYWORDS,
+    EMBED_ROUTE_THRESHOLD, EMBED_ROUTE_MARGIN, EMBED_BACKOFF_SECONDS, ROUTER_GENERATION_CONFIG,
+    ROUTER_TIMEOUT_SECONDS, ANSWER_TIMEOUT_SECONDS, LLM_ATTEMPTS, STREAM_FLUSH_SECONDS,
+    MAX_CONTEXT_TOKENS, MIN_TAB_TOKENS, CHARS_PER_TOKEN, CALIBRATION_SAMPLE_CHARS,
+    TARGET_SHEET_MAX_ROWS, TASK_TAB_MAX_ROWS, HTTP_POOL_SIZE, SHEETS_TIMEOUT_SECONDS, SHEETS_ATTEMPTS,
+    CONTEXT_CACHE_MODEL, CONTEXT_CACHE_TTL_SECONDS, CONTEXT_CACHE_MIN_TOKENS,
+)
 
 # 1. Page Config
 st.set_page_config(page_title="Project Hub", layout="wide", initial_sidebar_state="expanded")
@@ -29,14 +51,34 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # 2. Setup Gemini
-if "GEMINI_API_KEY" in st.secrets:
+@st.cache_resource
+def get_model():
     genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-    model = genai.GenerativeModel('models/gemini-2.0-flash')
+    return genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=GENERATION_CONFIG)
+
+if "GEMINI_API_KEY" in st.secrets:
+    model = get_model()
 else:
     st.error("Missing Gemini API Key in Secrets")
 
 # 3. Setup GSpread
-if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
+class BoundedBackOffHTTPClient(gspread.http_client.HTTPClient):
+    """Retries 408/429/5xx a few times with backoff, then lets the error through.
+
+    gspread's BackOffHTTPClient never gives up and keeps its retry count on the
+    (shared) instance; here the count is per call, so threads don't interfere.
+    """
+    def request(self, *args, **kwargs):
+        for attempt in range(SHEETS_ATTEMPTS):
+            try:
+                return super().request(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                if attempt == SHEETS_ATTEMPTS - 1 or not (status in (408, 429) or status >= 500): raise
+                time.sleep(2 ** attempt + random.random())
+
+@st.cache_resource
+def get_gspread_client():
     secrets = st.secrets["connections"]["gsheets"]
     scope = ['https://www.googleapis.com/auth/spreadsheets']
     creds = Credentials.from_service_account_info({
@@ -51,153 +93,697 @@ if "connections" in st.secrets and "gsheets" in st.secrets["connections"]:
         "auth_provider_x509_cert_url": secrets["auth_provider_x509_cert_url"],
         "client_x509_cert_url": secrets["client_x509_cert_url"]
     }, scopes=scope)
-    client = gspread.authorize(creds)
-else:
+    # One pooled keep-alive session for the whole process - no TCP/TLS handshake per Sheets call
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    client = gspread.Client(auth=creds, session=session, http_client=BoundedBackOffHTTPClient)
+    # gspread's default is no timeout - a hung request would hold a reader thread forever
+    client.set_timeout(SHEETS_TIMEOUT_SECONDS)
+    return client
+
+@st.cache_resource
+def get_spreadsheet(url):
+    # open_by_url is a Drive lookup - do it once per process, not per call
+    return get_gspread_client().open_by_url(url)
+
+@st.cache_resource
+def get_worksheet(url, idx_or_title):
+    sh = get_spreadsheet(url)
+    if isinstance(idx_or_title, int):
+        return sh.get_worksheet(idx_or_title)
+    return sh.worksheet(idx_or_title)
+
+def drop_stale_handles(error):
+    """Forgets cached handles that an APIError shows are no longer valid."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status in (401, 403, 404):
+        # Sheet deleted/unshared or auth revoked - reopen on the next call
+        get_worksheet.clear()
+        get_spreadsheet.clear()
+    if status in (400, 404):
+        # Usually a renamed or deleted tab named in a batchGet range
+        get_tab_titles.clear()
+
+# Network, quota and credential (refresh/transport) failures, plus open_by_url's
+# missing (SpreadsheetNotFound) / unshared (PermissionError) sheet - the app keeps running on these
+SHEETS_ERRORS = (gspread.exceptions.APIError, gspread.exceptions.SpreadsheetNotFound, PermissionError,
+                 RequestException, GoogleAuthError)
+STORE_ERRORS = (sqlite3.Error,) + SHEETS_ERRORS
+
+SHEETS_CONFIGURED = "connections" in st.secrets and "gsheets" in st.secrets["connections"]
+if not SHEETS_CONFIGURED:
     st.error("Secrets not configured correctly.")
 
 # --- DATABASE FUNCTIONS ---
-def get_all_history():
+@st.cache_resource
+def get_db():
+    con = sqlite3.connect(MEMORY_DB_PATH, check_same_thread=False)
+    con.execute('CREATE TABLE IF NOT EXISTS msgs(session_id TEXT, role TEXT, content TEXT, ts TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_msgs_session ON msgs(session_id)')
+    if SHEETS_CONFIGURED and con.execute('SELECT 1 FROM msgs LIMIT 1').fetchone() is None:
+        # Fresh DB (new deploy) - seed it from the memory sheet once. A transient
+        # failure propagates so cache_resource retries on the next rerun instead
+        # of caching an unseeded DB; a missing/unshared sheet won't come back on
+        # retry, so the local store starts empty instead.
+        try:
+            ws = get_worksheet(MEMORY_SHEET_URL, 0)
+            if ws and ws.row_count > 1:
+                vals = ws.get_all_values()
+                rows = [(r + [""] * 4)[:4] for r in vals[1:]]
+                con.executemany('INSERT INTO msgs VALUES (?, ?, ?, ?)', rows)
+        except gspread.exceptions.WorksheetNotFound:
+            pass
+        except SHEETS_ERRORS as e:
+            drop_stale_handles(e)
+            if _is_transient(e):
+                con.close()
+                raise
+            print(f"History import skipped: {e}")
+    con.commit()
+    return con
+
+@st.cache_resource
+def get_db_lock():
+    return threading.Lock()
+
+@st.cache_data(ttl=SESSIONS_CACHE_TTL, show_spinner=False)
+def _fetch_recent_sessions(limit):
+    # Newest sessions first, labelled with the session's first timestamp. Raises on
+    # failure so an empty sidebar isn't cached for the whole TTL.
+    with get_db_lock():
+        return get_db().execute(
+            'SELECT session_id, MIN(ts) AS first_ts FROM msgs '
+            'GROUP BY session_id ORDER BY first_ts DESC LIMIT ?', (limit,)).fetchall()
+
+def get_recent_sessions(limit=SIDEBAR_SESSION_LIMIT):
     try:
-        sh = client.open_by_url(MEMORY_SHEET_URL)
-        ws = sh.get_worksheet(0)
-        return pd.DataFrame(ws.get_all_records())
-    except:
-        return pd.DataFrame()
+        return _fetch_recent_sessions(limit)
+    except STORE_ERRORS as e:
+        print(f"History load failed: {e}")
+        return []
 
 def load_session_messages(session_id):
-    df = get_all_history()
-    if df.empty: return []
-    df['Session_ID'] = df['Session_ID'].astype(str)
-    session_data = df[df['Session_ID'] == str(session_id)]
-    messages = []
-    for index, row in session_data.iterrows():
-        messages.append({"role": row["Role"], "content": row["Content"]})
-    return messages
-
-def save_message(session_id, role, content):
     try:
-        sh = client.open_by_url(MEMORY_SHEET_URL)
-        ws = sh.get_worksheet(0)
-        if ws.row_count > 0:
-            val = ws.acell('A1').value
-            if not val:
-                 ws.append_row(["Session_ID", "Role", "Content", "Timestamp"])
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ws.append_row([str(session_id), role, content, timestamp])
+        with get_db_lock():
+            rows = get_db().execute('SELECT role, content FROM msgs WHERE session_id = ? ORDER BY rowid', (str(session_id),)).fetchall()
+    except STORE_ERRORS as e:
+        print(f"Session load failed: {e}")
+        return []
+    return [{"role": role, "content": content} for role, content in rows]
+
+@st.cache_resource
+def _ensure_headers(url):
+    # The header row never changes once written, so probe A1 once per process
+    ws = get_worksheet(url, 0)
+    if not ws.acell('A1').value:
+        ws.append_row(["Session_ID", "Role", "Content", "Timestamp"], value_input_option='RAW')
+    return True
+
+def _is_transient(error):
+    # Quota (429), server-side (5xx) and network failures are worth retrying; other 4xx never succeed
+    if isinstance(error, gspread.exceptions.APIError):
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        return status == 429 or (status or 0) >= 500
+    return isinstance(error, (RequestException, GoogleAuthError))
+
+def _append_to_memory_sheet(rows):
+    """Appends rows to the memory sheet and returns the ones to retry later."""
+    try:
+        get_worksheet(MEMORY_SHEET_URL, 0).append_rows(rows, value_input_option='RAW')
+        return []
     except Exception as e:
+        drop_stale_handles(e)
+        if _is_transient(e):
+            print(f"Sheet sync failed, {len(rows)} rows kept for retry: {e}")
+            return rows
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        if status != 400 or len(rows) == 1:
+            # Permission/config problem, or one bad row (e.g. a cell over the 50k-character
+            # limit) - the rows stay in the local store only
+            print(f"Sheet sync rejected {len(rows)} rows, dropped: {e}")
+            return []
+    # A 400 is usually one row's content - split the batch so only that row is lost
+    middle = len(rows) // 2
+    return _append_to_memory_sheet(rows[:middle]) + _append_to_memory_sheet(rows[middle:])
+
+# Queued after a turn's last row to push the batch out right away
+_SYNC_FLUSH = object()
+
+def _sync_rows_to_sheet(rows_queue):
+    # Normally flushed once per chat turn (_SYNC_FLUSH); size/age limits are a safety net
+    batch, first_queued, retry_at, stopping = [], None, 0, False
+    while not stopping:
+        flush_now = False
+        try:
+            row = rows_queue.get(timeout=SYNC_INTERVAL_SECONDS)
+            if row is None:
+                stopping = True
+            elif row is _SYNC_FLUSH:
+                flush_now = True
+            else:
+                batch.append(row)
+                first_queued = first_queued or time.time()
+        except queue.Empty:
+            pass
+        due = first_queued and time.time() - first_queued >= SYNC_INTERVAL_SECONDS
+        # After a failed attempt, wait out a full interval before hitting the sheet again
+        backing_off = not stopping and time.time() < retry_at
+        if batch and not backing_off and (stopping or flush_now or due or len(batch) >= SYNC_BATCH_ROWS):
+            batch = _append_to_memory_sheet(batch)
+            if len(batch) > SYNC_MAX_PENDING_ROWS:
+                print(f"Sheet sync backlog full, {len(batch) - SYNC_MAX_PENDING_ROWS} oldest rows dropped")
+                batch = batch[-SYNC_MAX_PENDING_ROWS:]
+            first_queued = first_queued if batch else None
+            retry_at = time.time() + SYNC_INTERVAL_SECONDS if batch else 0
+
+@st.cache_resource
+def get_sheet_sync_queue():
+    rows_queue = queue.Queue(maxsize=SYNC_QUEUE_SIZE)
+    worker = threading.Thread(target=_sync_rows_to_sheet, args=(rows_queue,), name="sheet-sync", daemon=True)
+    worker.start()
+
+    def _drain():
+        # Never block exit: a full queue means the worker is stuck and can't be drained anyway
+        try:
+            rows_queue.put(None, timeout=5)
+        except queue.Full:
+            print(f"Sheet sync queue full at exit, {rows_queue.qsize()} rows kept locally only")
+            return
+        worker.join(timeout=30)
+    atexit.register(_drain)
+    return rows_queue
+
+@st.cache_resource
+def get_read_executor():
+    # Sheets and Gemini calls are blocking HTTP, so threads overlap them
+    executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="sheet-reader")
+    atexit.register(executor.shutdown, wait=False)
+    return executor
+
+def save_message(session_id, role, content, flush=False):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    row = [str(session_id), role, content, timestamp]
+    try:
+        with get_db_lock(), get_db() as con:
+            con.execute('INSERT INTO msgs VALUES (?, ?, ?, ?)', row)
+    except STORE_ERRORS as e:
         print(f"Save failed: {e}")
+    if not SHEETS_CONFIGURED: return
+    try:
+        get_sheet_sync_queue().put_nowait(row)
+        if flush: get_sheet_sync_queue().put_nowait(_SYNC_FLUSH)
+    except queue.Full:
+        print("Sheet sync queue full, message kept locally only")
 
 # --- HELPER FUNCTIONS ---
 
-@st.cache_data(ttl=600)
+@st.cache_data(ttl=MAP_CACHE_TTL, show_spinner=False)
+def _fetch_project_map():
+    # Raises on failure (not cached), so one bad read doesn't blank routing for the whole TTL.
+    # The caches derived from the map read it through here for the same reason.
+    return get_worksheet(MASTER_SHEET_URL, LINKS_TAB_NAME).get_all_records()
+
 def get_project_map():
+    if not SHEETS_CONFIGURED: return []
     try:
-        sh = client.open_by_url(MASTER_SHEET_URL)
-        ws = sh.worksheet(LINKS_TAB_NAME)
-        return ws.get_all_records()
-    except Exception as e:
+        return _fetch_project_map()
+    except (gspread.exceptions.WorksheetNotFound,) + SHEETS_ERRORS as e:
+        drop_stale_handles(e)
+        print(f"Project map load failed: {e}")
         return []
 
+@st.cache_data(ttl=MAP_CACHE_TTL, show_spinner=False)
+def get_router_map_json():
+    # Only the fields the router needs, serialized once per map refresh
+    slim = [{'n': r.get('Project Name', ''), 'c': r.get('Category', ''), 'u': r.get('Raw Link', '')} for r in _fetch_project_map()]
+    return json.dumps(slim, separators=(',', ':'), ensure_ascii=False)
+
+@st.cache_data(ttl=TAB_TITLES_CACHE_TTL, show_spinner=False)
+def get_tab_titles(url):
+    # Tab layout rarely changes; saves the metadata round-trip ahead of each batchGet
+    return [ws.title for ws in get_spreadsheet(url).worksheets()]
+
+def batch_read_tabs(sh, titles, max_rows):
+    """Reads the first max_rows of each tab in a single values.batchGet request."""
+    if not titles: return []
+    ranges = ["'{}'!1:{}".format(t.replace("'", "''"), max_rows) for t in titles]
+    response = sh.values_batch_get(ranges)
+    return [(t, vr.get('values', [])) for t, vr in zip(titles, response.get('valueRanges', []))]
+
+def rows_to_tsv(rows):
+    """Serializes sheet rows as TSV, which costs far fewer tokens than the list repr."""
+    rows = [[" ".join(str(cell).split()) for cell in row] for row in rows]
+    while rows and not any(rows[-1]): rows.pop()
+    # Spacer columns (empty in every row, header included) carry no information
+    width = max((len(row) for row in rows), default=0)
+    used = [c for c in range(width) if any(c < len(row) and row[c] for row in rows)]
+    if len(used) < width:
+        rows = [[row[c] if c < len(row) else "" for c in used] for row in rows]
+    lines = []
+    for row in rows:
+        while row and not row[-1]: row.pop()
+        lines.append("\t".join(row))
+    return "\n".join(lines)
+
+# The cached readers raise on failure - st.cache_data doesn't store exceptions,
+# so one failed read isn't served to every session for the whole TTL.
+@st.cache_data(ttl=SHEET_CACHE_TTL, show_spinner=False)
+def _fetch_target_tabs(url):
+    # (tab title, TSV) per tab - keyed on the URL alone so every label shares one read
+    sh = get_spreadsheet(url)
+    titles = [t for t in get_tab_titles(url) if t not in ["Instructions", "Admin"]]
+    return [(title, rows_to_tsv(truncated_data)) for title, truncated_data in batch_read_tabs(sh, titles, TARGET_SHEET_MAX_ROWS)]
+
+@st.cache_data(ttl=TASKS_CACHE_TTL, show_spinner=False)
+def _fetch_master_task_tabs():
+    sh = get_spreadsheet(MASTER_SHEET_URL)
+    ignore_list = [LINKS_TAB_NAME, LOGS_TAB_NAME, REF_DATA_TAB_NAME, "Instructions"]
+    titles = [t for t in get_tab_titles(MASTER_SHEET_URL) if t not in ignore_list]
+    all_content = []
+    for title, truncated_data in batch_read_tabs(sh, titles, TASK_TAB_MAX_ROWS):
+        tab_text = f"--- INTERNAL TASKS: '{title}' ---\n{rows_to_tsv(truncated_data)}\n"
+        all_content.append(tab_text)
+    return all_content
+
+# Failed reads come back as a single text block the model can explain to the user
+READ_ERROR_PREFIX = "Error reading "
+
+def read_failed(blocks):
+    return any(block.startswith(READ_ERROR_PREFIX) for block in blocks)
+
 def read_target_sheet(url, sheet_title_hint="Sheet"):
     try:
-        sh = client.open_by_url(url)
-        all_content = []
-        for ws in sh.worksheets():
-            if ws.title in ["Instructions", "Admin"]: continue
-            raw_data = ws.get_all_values()
-            truncated_data = raw_data[:300] 
-            tab_text = f"--- DATA FROM '{sheet_title_hint}' (Tab: {ws.title}) ---\n{str(truncated_data)}\n"
-            all_content.append(tab_text)
-        return "\n".join(all_content)
+        tabs = _fetch_target_tabs(url)
     except Exception as e:
-        return f"Error reading {sheet_title_hint}: {e}"
+        drop_stale_handles(e)
+        return [f"{READ_ERROR_PREFIX}{sheet_title_hint}: {e}"]
+    return [f"--- DATA FROM '{sheet_title_hint}' (Tab: {title}) ---\n{tsv}\n" for title, tsv in tabs]
 
 def read_master_task_tabs():
     try:
-        sh = client.open_by_url(MASTER_SHEET_URL)
-        all_content = []
-        ignore_list = [LINKS_TAB_NAME, LOGS_TAB_NAME, "Ref_Data", "Instructions"]
-        for ws in sh.worksheets():
-            if ws.title in ignore_list: continue
-            raw_data = ws.get_all_values()
-            truncated_data = raw_data[:100]
-            tab_text = f"--- INTERNAL TASKS: '{ws.title}' ---\n{str(truncated_data)}\n"
-            all_content.append(tab_text)
-        return "\n".join(all_content)
+        return _fetch_master_task_tabs()
     except Exception as e:
-        return str(e)
+        drop_stale_handles(e)
+        return [f"{READ_ERROR_PREFIX}internal tasks: {e}"]
+
+@st.cache_resource
+def get_context_caches():
+    # {sha256 of prefix: (CachedContent or None while it's being created, expires_at)} shared by every session
+    return {}, threading.Lock()
+
+def get_cached_model(prefix):
+    """A model bound to a server-side Gemini cache of `prefix`, or None to send it inline."""
+    if len(prefix) / chars_per_token(prefix) < CONTEXT_CACHE_MIN_TOKENS: return None
+    key = hashlib.sha256(prefix.encode()).hexdigest()
+    caches, lock = get_context_caches()
+    with lock:
+        now = time.time()
+        for stale in [k for k, (_, expires_at) in caches.items() if expires_at <= now]:
+            del caches[stale]
+        entry = caches.get(key)
+        if entry is None:
+            # Claim the key; the upload happens outside the lock so other turns aren't held up
+            caches[key] = (None, now + ANSWER_TIMEOUT_SECONDS)
+    if entry is not None:
+        cached = entry[0]
+        if cached is None: return None  # Another turn is still uploading this prefix - send it inline
+    else:
+        try:
+            cached = genai.caching.CachedContent.create(
+                model=CONTEXT_CACHE_MODEL, contents=[prefix], ttl=timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS))
+        except Exception as e:
+            with lock:
+                caches.pop(key, None)
+            print(f"Context cache create failed: {e}")
+            return None
+        with lock:
+            # Expire locally a little early so we never hand out a cache the server just dropped
+            caches[key] = (cached, now + CONTEXT_CACHE_TTL_SECONDS - 30)
+    return genai.GenerativeModel.from_cached_content(cached_content=cached, generation_config=GENERATION_CONFIG)
+
+def call_llm(prompt, timeout, llm=None, **kwargs):
+    """generate_content with a deadline, retried so one slow call can't stall the turn."""
+    for attempt in range(LLM_ATTEMPTS):
+        try:
+            return (llm or model).generate_content(prompt, request_options={'timeout': timeout}, **kwargs)
+        except DeadlineExceeded:
+            if attempt == LLM_ATTEMPTS - 1: raise
+
+def _batched_text(response):
+    # Gemini can emit many tiny chunks; coalesce them so the UI isn't redrawn per chunk
+    buffer, last_flush = [], time.time()
+    for chunk in response:
+        buffer.append(chunk.text)
+        if time.time() - last_flush >= STREAM_FLUSH_SECONDS:
+            yield "".join(buffer)
+            buffer, last_flush = [], time.time()
+    if buffer:
+        yield "".join(buffer)
+
+def stream_answer(prompt, llm=None):
+    """Streams a Gemini answer into the current container and returns the full text."""
+    response = call_llm(prompt, ANSWER_TIMEOUT_SECONDS, llm=llm, stream=True)
+    return st.write_stream(_batched_text(response))
+
+def set_messages(messages):
+    """Replaces the conversation and re-seeds the context tail from it."""
+    st.session_state.messages = messages
+    # One extra slot for the prompt being answered, which get_recent_context skips
+    st.session_state.recent = deque(messages[-(CONTEXT_MESSAGES + 1):], maxlen=CONTEXT_MESSAGES + 1)
+
+def add_message(role, content):
+    message = {"role": role, "content": content}
+    st.session_state.messages.append(message)
+    st.session_state.recent.append(message)
 
 def get_recent_context():
-    if "messages" not in st.session_state: return ""
-    history = st.session_state.messages[:-1][-3:]
-    context_text = ""
-    for msg in history:
-        context_text += f"{msg['role'].upper()}: {msg['content']}\n"
-    return context_text
-
-def identify_project_in_prompt(prompt, project_map):
+    return "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in list(st.session_state.recent)[:-1])
+
+@st.cache_resource(ttl=MAP_CACHE_TTL)
+def _build_project_name_index():
+    # We no longer need to filter out 'Inventory' because it's hardcoded
+    names = {str(row['Project Name']).lower(): row['Project Name'] for row in _fetch_project_map() if row.get('Project Name')}
+    # Longest names first so "Project A Part 2" wins over "Project A" at the same spot;
+    # the lookahead tries every position, so overlapping names are all found
+    ordered = sorted(names, key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(re.escape(n) for n in ordered) + "))") if ordered else None
+    return names, pattern
+
+def get_project_name_index():
+    """({lowercased name: original name}, compiled matcher), built once per map refresh."""
+    if not SHEETS_CONFIGURED: return {}, None
+    try:
+        return _build_project_name_index()
+    except Exception as e:
+        drop_stale_handles(e)
+        print(f"Project name index failed: {e}")
+        return {}, None
+
+def identify_project_in_prompt(prompt):
     """Finds if a project name exists in the user prompt."""
-    prompt_lower = prompt.lower()
-    if isinstance(project_map, list):
-        # We no longer need to filter out 'Inventory' because it's hardcoded
-        project_names = set(row['Project Name'] for row in project_map)
-        
-        # Sort by length descending to catch longer names first
-        for name in sorted(project_names, key=len, reverse=True):
-            if name.lower() in prompt_lower:
-                return name
+    names, pattern = get_project_name_index()
+    if pattern is None: return None
+    # One scan of the prompt finds every name, overlapping ones included; keep the longest hit
+    hits = pattern.findall(prompt.lower())
+    return names[max(hits, key=len)] if hits else None
+
+def fuzzy_match_project(prompt):
+    """Matches near-miss project names (typos, stray punctuation) without an LLM call."""
+    names, _ = get_project_name_index()
+    words = [w.strip(".,!?;:'\"()") for w in prompt.lower().split()]
+    best_name, best_score = None, FUZZY_MATCH_CUTOFF
+    for name_lower, name in names.items():
+        size = len(name_lower.split())
+        for i in range(len(words) - size + 1):
+            score = difflib.SequenceMatcher(None, name_lower, " ".join(words[i:i + size])).ratio()
+            if score >= best_score:
+                best_name, best_score = name, score
+    return best_name
+
+_STOPWORDS = frozenset("""
+    the and for are was were has have had does did not but can could would should will
+    what when where which who whom whose why how this that these those there their them they
+    with from into onto about than then any all its our your you yours out now just also
+    please tell show give get got much many more some been being
+""".split())
+
+def _keywords(text):
+    # Content words only - "what"/"the" would make unrelated prompts look alike
+    return {w for w in re.findall(r"[a-z0-9]+", str(text).lower()) if len(w) > 2 and w not in _STOPWORDS}
+
+@st.cache_resource
+def get_response_cache():
+    # {key: (answer, stored_at)} oldest first, plus a lock for cross-session access
+    return OrderedDict(), threading.Lock()
+
+def response_cache_key(prompt, scope):
+    if not scope:
+        return None  # Unscoped questions are too easy to confuse across sessions
+    # The project name says nothing about what's asked - only the other words count
+    if len(_keywords(prompt) - _keywords(scope)) < RESPONSE_CACHE_MIN_KEYWORDS:
+        return None  # Short follow-ups lean on chat context - never share those
+    # Only case and punctuation are ignored; word order, numbers and "not" all change the question
+    return f"{scope}||{' '.join(re.findall(r'[a-z0-9]+', prompt.lower()))}"
+
+def get_cached_answer(key):
+    if not key: return None
+    cache, lock = get_response_cache()
+    with lock:
+        entry = cache.get(key)
+    if entry and time.time() - entry[1] < RESPONSE_CACHE_TTL:
+        return entry[0]
     return None
 
+def cache_answer(key, answer):
+    if not key: return
+    cache, lock = get_response_cache()
+    with lock:
+        cache[key] = (answer, time.time())
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+@st.cache_data(show_spinner=False)
+def _calibrated_chars_per_token(model_name, _sample):
+    # _sample isn't hashed, so this runs once per model on the first real sheet text
+    return len(_sample) / max(model.count_tokens(_sample).total_tokens, 1)
+
+def chars_per_token(sample):
+    try:
+        return _calibrated_chars_per_token(model.model_name, sample[:CALIBRATION_SAMPLE_CHARS])
+    except Exception as e:
+        print(f"Token calibration failed: {e}")
+        return CHARS_PER_TOKEN
+
+def _truncate_rows(block, max_chars):
+    # Cut on a row boundary so the model never sees half a row
+    if len(block) <= max_chars: return block
+    cut = block.rfind("\n", 0, max_chars)
+    return block[:cut if cut > 0 else max_chars] + "\n[...more rows truncated]\n"
+
+def pack_context(blocks, prompt, max_tokens=MAX_CONTEXT_TOKENS):
+    """Fits the tab blocks into the token budget, trimming rows from the largest tabs.
+
+    When the budget can't give every tab MIN_TAB_TOKENS, the tabs least
+    relevant to the prompt are dropped first.
+    """
+    if not blocks: return ""
+    words = _keywords(prompt)
+
+    def relevance(block):
+        counts = Counter(re.findall(r"[a-z0-9]+", block.lower()))
+        norm = math.sqrt(sum(v * v for v in counts.values())) or 1
+        return sum(counts[w] for w in words) / norm
+
+    rate = chars_per_token("\n".join(blocks))
+    budget = int(max_tokens * rate)
+    keep = sorted(range(len(blocks)), key=lambda i: relevance(blocks[i]), reverse=True)
+    while len(keep) > 1 and budget / len(keep) < MIN_TAB_TOKENS * rate:
+        keep.pop()
+
+    # Small tabs go in whole; the larger ones split what's left evenly
+    allowance, remaining = {}, budget
+    pending = sorted(keep, key=lambda i: len(blocks[i]))
+    while pending:
+        share = remaining // len(pending)
+        if len(blocks[pending[0]]) > share:
+            for i in pending: allowance[i] = share
+            break
+        i = pending.pop(0)
+        allowance[i] = len(blocks[i])
+        remaining -= allowance[i]
+    # Keep sheet order so the same tabs always produce the same text
+    return "\n".join(_truncate_rows(blocks[i], allowance[i]) for i in sorted(keep))
+
+def remember_route(prompt, url):
+    """Records which sheet a prompt was routed to, to guide later prefetches."""
+    routes = st.session_state.setdefault("route_history", OrderedDict())
+    for word in _keywords(prompt):
+        routes[word] = url
+        routes.move_to_end(word)
+    while len(routes) > ROUTE_HISTORY_SIZE:
+        routes.popitem(last=False)
+
+def prefetch_likely_sheets(prompt, project_map):
+    """Starts reading the most probable target sheets while the router LLM is thinking.
+
+    Returns the (url, score) AI_LINKS label matches, best first. Route history
+    only steers which sheets get prefetched - it's too loose to route on.
+    """
+    words = _keywords(prompt)
+    candidates = [(row.get('Raw Link'), f"{row.get('Project Name', '')} {row.get('Category', '')}") for row in project_map]
+    candidates.append((STOCK_SHEET_URL, "Global Stock Inventory Wood"))
+    label_scores = Counter()
+    for url, label in candidates:
+        if url: label_scores[url] += len(words & _keywords(label))
+    scores = Counter(label_scores)
+    routes = st.session_state.get("route_history", {})
+    for word in words & routes.keys():
+        scores[routes[word]] += 1
+
+    prefetched = st.session_state.setdefault("_prefetch_cache", {})
+    now = time.time()
+    for url, score in scores.most_common(PREFETCH_TOP_K):
+        if score <= 0: break
+        if url in prefetched and now - prefetched[url][1] < PREFETCH_TTL_SECONDS: continue
+        prefetched[url] = (get_read_executor().submit(read_target_sheet, url, "Selected Sheet"), now)
+    return [(url, score) for url, score in label_scores.most_common(2) if score > 0]
+
+def confident_route(candidates):
+    # Skip the router LLM when one sheet clearly wins on its AI_LINKS label
+    if not candidates or candidates[0][1] < CONFIDENT_ROUTE_SCORE: return None
+    if len(candidates) > 1 and candidates[1][1] >= candidates[0][1]: return None
+    return {"url": candidates[0][0], "reason": "Keyword match", "category": ""}
+
+def _fast_route(prompt):
+    # Tasks and stock questions are predictable from their wording - no model call at all
+    prompt_lower = prompt.lower()
+    is_tasks = any(k in prompt_lower for k in TASK_ROUTE_KEYWORDS)
+    is_stock = bool(STOCK_SHEET_URL) and any(k in prompt_lower for k in STOCK_ROUTE_KEYWORDS)
+    if is_tasks == is_stock: return None  # nothing matched, or ambiguous
+    if is_tasks: return {"url": "INTERNAL_TASKS", "reason": "Keyword match", "category": "Tasks"}
+    return {"url": STOCK_SHEET_URL, "reason": "Keyword match", "category": "Stock"}
+
+def _unit(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1
+    return [x / norm for x in vector]
+
+@st.cache_data(ttl=MAP_CACHE_TTL, show_spinner=False)
+def get_route_embeddings():
+    """(url, unit vector) for every routable sheet, embedded once per map refresh."""
+    routes = [(r['Raw Link'], f"{r.get('Project Name', '')} - {r.get('Category', '')}: {r.get('Content Description', '')}")
+              for r in _fetch_project_map() if r.get('Raw Link')]
+    routes.append((STOCK_SHEET_URL, "Global stock: inventory, wood stock levels, live counts"))
+    routes.append(("INTERNAL_TASKS", "Internal tasks: schedule, people, who is working on what"))
+    result = genai.embed_content(model=EMBEDDING_MODEL, content=[text for _, text in routes], task_type="retrieval_document",
+                                 request_options={'timeout': ROUTER_TIMEOUT_SECONDS})
+    return [(url, _unit(vec)) for (url, _), vec in zip(routes, result['embedding'])]
+
+@st.cache_resource
+def get_embedding_backoff():
+    # Shared by every session: {"until": time the embedding router may be tried again}
+    return {"until": 0.0}
+
+def embedding_route(prompt):
+    # One embedding call (~100ms) instead of a full router generation; None when unsure
+    backoff = get_embedding_backoff()
+    if time.time() < backoff["until"]: return None
+    try:
+        routes = get_route_embeddings()
+        query = _unit(genai.embed_content(model=EMBEDDING_MODEL, content=prompt, task_type="retrieval_query",
+                                          request_options={'timeout': ROUTER_TIMEOUT_SECONDS})['embedding'])
+    except Exception as e:
+        # Failures aren't cached - without this every turn would re-embed the whole map first
+        backoff["until"] = time.time() + EMBED_BACKOFF_SECONDS
+        print(f"Embedding route failed: {e}")
+        return None
+    # Best score per sheet (map rows can share a link), so the runner-up is a different sheet
+    scores = {}
+    for u, v in routes:
+        scores[u] = max(scores.get(u, -1), sum(a * b for a, b in zip(query, v)))
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    if not ranked: return None
+    url, score = ranked[0]
+    if score < EMBED_ROUTE_THRESHOLD: return None
+    if len(ranked) > 1 and score - ranked[1][1] < EMBED_ROUTE_MARGIN: return None
+    return {"url": url, "reason": f"Embedding match ({score:.2f})", "category": ""}
+
+def read_selected_sheet(url):
+    # Reuse an in-flight/finished prefetch if the router agreed with our guess
+    entry = st.session_state.get("_prefetch_cache", {}).get(url)
+    if entry and time.time() - entry[1] < PREFETCH_TTL_SECONDS:
+        return entry[0].result()
+    return read_target_sheet(url, "Selected Sheet")
+
 # --- APP STARTUP ---
+if SHEETS_CONFIGURED:
+    try:
+        _ensure_headers(MEMORY_SHEET_URL)
+    except Exception as e:
+        print(f"Header check failed: {e}")
+
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
 
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+if "recent" not in st.session_state:
+    set_messages(st.session_state.get("messages", []))
 
 # --- SIDEBAR ---
 with st.sidebar:
     st.title("🗂️ Menu")
     if st.button("➕ START NEW CHAT", type="primary"):
         st.session_state.session_id = str(uuid.uuid4())
-        st.session_state.messages = []
+        set_messages([])
+        st.session_state.show_full_history = False
         st.rerun()
+    if st.button("🔄 Refresh map"):
+        # AI_LINKS was edited - drop the cached map and sheet reads
+        _fetch_project_map.clear()
+        get_router_map_json.clear()
+        _build_project_name_index.clear()
+        get_route_embeddings.clear()
+        get_tab_titles.clear()
+        _fetch_target_tabs.clear()
+        _fetch_master_task_tabs.clear()
+    if st.button("🧹 Clear answer cache"):
+        cache, lock = get_response_cache()
+        with lock:
+            cache.clear()
     st.divider()
     
     with st.spinner("Loading history..."):
-        df_history = get_all_history()
-
-    if not df_history.empty and 'Session_ID' in df_history.columns:
-        unique_sessions = df_history[['Session_ID', 'Timestamp']].drop_duplicates(subset=['Session_ID']).sort_values(by='Timestamp', ascending=False)
-        for index, row in unique_sessions.head(10).iterrows():
-            sid = row['Session_ID']
-            ts = row['Timestamp']
-            if st.button(f"📅 {ts}", key=sid):
-                st.session_state.session_id = sid
-                st.session_state.messages = load_session_messages(sid)
-                st.rerun()
+        unique_sessions = get_recent_sessions()
+
+    for sid, ts in unique_sessions:
+        if st.button(f"📅 {ts}", key=sid):
+            st.session_state.session_id = sid
+            set_messages(load_session_messages(sid))
+            st.session_state.show_full_history = False
+            st.rerun()
 
 # --- MAIN CHAT ---
 st.title("🤖 Project Hub")
 
-for message in st.session_state.messages:
+history = st.session_state.messages
+hidden_count = len(history) - HISTORY_RENDER_LIMIT
+if hidden_count > 0 and not st.session_state.get("show_full_history"):
+    if st.button(f"⬆️ Show {hidden_count} earlier messages"):
+        st.session_state.show_full_history = True
+        st.rerun()
+    history = history[hidden_count:]
+
+for message in history:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
 if prompt := st.chat_input("Ask about projects, estimation, or tasks..."):
     st.chat_message("user").markdown(prompt)
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    is_new_session = not st.session_state.messages
+    add_message("user", prompt)
     save_message(st.session_state.session_id, "user", prompt)
+    if is_new_session:
+        # Only a brand-new session changes the sidebar list
+        _fetch_recent_sessions.clear()
 
     with st.spinner("Processing request..."):
         project_map = get_project_map()
         chat_context = get_recent_context()
-        detected_project = identify_project_in_prompt(prompt, project_map)
+        detected_project = identify_project_in_prompt(prompt) or fuzzy_match_project(prompt)
+        cache_key = response_cache_key(prompt, detected_project)
+        cached_answer = get_cached_answer(cache_key)
         
         final_answer = ""
+        answer_prompt = None
+        answer_model = None
+        error_label = "System Error"
         
+        # --- CACHE HIT: SAME QUESTION ASKED RECENTLY ---
+        if cached_answer:
+            st.toast("Answered from recent results")
+            final_answer = cached_answer
+
         # --- PATH A: PROJECT DETECTED (MULTI-SHEET MODE) ---
-        if detected_project:
+        elif detected_project:
             status_text = f"Analying **{detected_project}** + **Stock Levels**..."
             st.toast(status_text)
             
@@ -211,23 +797,24 @@ if prompt := st.chat_input("Ask about projects, estimation, or tasks..."):
             if STOCK_SHEET_URL:
                 target_urls.append({"url": STOCK_SHEET_URL, "name": "Global Inventory & Wood Stock"})
 
-            # 3. Read Data
-            mega_context = ""
-            for target in target_urls:
-                if target['url']:
-                    data = read_target_sheet(target['url'], target['name'])
-                    mega_context += f"\n\n=== FILE: {target['name']} ===\n{data}"
+            # 3. Read Data (concurrently - total wait is the slowest sheet, not the sum)
+            # One worker per distinct link (map rows can share a sheet), in a stable
+            # order so repeat questions share the same prompt prefix
+            names_by_url = {}
+            for t in target_urls:
+                if t['url']: names_by_url.setdefault(t['url'], []).append(t['name'])
+            target_urls = sorted(({"url": u, "name": " / ".join(n)} for u, n in names_by_url.items()), key=lambda t: t['name'])
+            sheet_data = get_read_executor().map(lambda t: read_target_sheet(t['url'], t['name']), target_urls)
+            blocks = [tab for tabs in sheet_data for tab in tabs]
+            if read_failed(blocks):
+                cache_key = None  # An answer built around a failed read mustn't be reused
+            mega_context = pack_context(blocks, prompt)
             
-            # 4. Estimation Prompt
-            final_prompt = f"""
+            # 4. Estimation Prompt (static instructions + sheet data first, per-turn text last,
+            #    so the large part can be cached by Gemini across turns)
+            estimation_prefix = f"""
             You are an expert Production Estimator.
             
-            USER QUESTION: "{prompt}"
-            CONTEXT: {chat_context}
-            
-            DATA SOURCES (Includes Project Sheets + Global Inventory):
-            {mega_context}
-            
             INSTRUCTIONS FOR ESTIMATION:
             1. Look at 'Manufacturing' / 'Room Schedule' to see how many items are COMPLETE vs TOTAL.
                - Calculate % Complete.
@@ -236,51 +823,71 @@ if prompt := st.chat_input("Ask about projects, estimation, or tasks..."):
                - Show your math: (Used / % Complete) * % Remaining.
             4. Compare this requirement against 'Wood Stock' (Live Counts).
             5. Final Answer: "We need approx X more sheets. We have Y in stock. Result: Buy Z sheets."
+            
+            DATA SOURCES (Includes Project Sheets + Global Inventory):
+            {mega_context}
+            """
+            turn_prompt = f"""
+            CONTEXT: {chat_context}
+            USER QUESTION: "{prompt}"
             """
             
-            try:
-                final_answer = model.generate_content(final_prompt).text
-            except Exception as e:
-                final_answer = f"Error generating estimation: {e}"
+            # Big prefixes go into an explicit context cache; only the question is re-sent
+            answer_model = get_cached_model(estimation_prefix)
+            answer_prompt = turn_prompt if answer_model else estimation_prefix + turn_prompt
+            error_label = "Error generating estimation"
 
         # --- PATH B: NO PROJECT DETECTED (STANDARD ROUTER) ---
         else:
-            # We add Stock manually to the router options so you can still ask "Do we have Oak?"
-            router_prompt = f"""
-            You are a Routing Assistant. 
-            CONTEXT: {chat_context}
-            QUESTION: "{prompt}"
-            
-            OPTION 1: EXTERNAL PROJECT SHEETS
-            {json.dumps(project_map)}
-            
-            OPTION 2: GLOBAL STOCK
-            URL: {STOCK_SHEET_URL}
-            Category: Stock
-            
-            OPTION 3: INTERNAL TASKS
-            If asking about "Tasks", "Schedule", "People", return {{"url": "INTERNAL_TASKS", "reason": "Task request", "category": "Tasks"}}
-            
-            Return JSON in format: {{"url": "...", "reason": "...", "category": "..."}}
-            """
+            candidates = prefetch_likely_sheets(prompt, project_map)
+            # Task tabs are a common destination and cached for minutes - warm them during routing too
+            tasks_future = get_read_executor().submit(read_master_task_tabs)
             try:
-                router_response = model.generate_content(router_prompt)
-                clean_json = router_response.text.strip().replace("```json", "").replace("```", "")
-                decision = json.loads(clean_json)
+                decision = _fast_route(prompt) or confident_route(candidates) or embedding_route(prompt)
+                if decision is None:
+                    # We add Stock manually to the router options so you can still ask "Do we have Oak?"
+                    router_prompt = f"""
+                    You are a Routing Assistant. 
+
+                    OPTION 1: EXTERNAL PROJECT SHEETS (n = Project Name, c = Category, u = URL)
+                    {get_router_map_json()}
+
+                    OPTION 2: GLOBAL STOCK
+                    URL: {STOCK_SHEET_URL}
+                    Category: Stock
+
+                    OPTION 3: INTERNAL TASKS
+                    If asking about "Tasks", "Schedule", "People", use url "INTERNAL_TASKS" with category "Tasks".
+
+                    CONTEXT: {chat_context}
+                    QUESTION: "{prompt}"
+                    """
+                    router_response = call_llm(router_prompt, ROUTER_TIMEOUT_SECONDS, generation_config=ROUTER_GENERATION_CONFIG)
+                    decision = json.loads(router_response.text)
                 target_url = decision.get("url")
 
                 if target_url == "INTERNAL_TASKS":
-                    sheet_data = read_master_task_tabs()
-                    final_answer = model.generate_content(f"Answer using Tasks:\n{sheet_data}\nQuestion: {prompt}").text
+                    sheet_data = pack_context(tasks_future.result(), prompt)
+                    answer_prompt = f"Answer using Tasks:\n{sheet_data}\nQuestion: {prompt}"
                 elif target_url and target_url != "None":
-                    sheet_data = read_target_sheet(target_url, "Selected Sheet")
-                    final_answer = model.generate_content(f"Answer using Data:\n{sheet_data}\nQuestion: {prompt}\nCite sources!").text
+                    remember_route(prompt, target_url)
+                    sheet_data = pack_context(read_selected_sheet(target_url), prompt)
+                    answer_prompt = f"Answer using Data:\n{sheet_data}\nQuestion: {prompt}\nCite sources!"
                 else:
                     final_answer = "I couldn't find a relevant sheet. If asking about a job, use the exact Project Name."
             except Exception as e:
                 final_answer = f"System Error: {e}"
 
-        st.chat_message("assistant").markdown(final_answer)
-        st.session_state.messages.append({"role": "assistant", "content": final_answer})
-        save_message(st.session_state.session_id, "assistant", final_answer)
-        st.rerun()
+    # --- ANSWER (streamed so the first tokens show up immediately) ---
+    with st.chat_message("assistant"):
+        if answer_prompt:
+            try:
+                final_answer = stream_answer(answer_prompt, answer_model)
+                cache_answer(cache_key, final_answer)
+            except Exception as e:
+                final_answer = f"{error_label}: {e}"
+                st.markdown(final_answer)
+        else:
+            st.markdown(final_answer)
+    add_message("assistant", final_answer)
+    save_message(st.session_state.session_id, "assistant", final_answer, flush=True)
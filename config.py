@@ -0,0 +1,97 @@
+# --- CONFIGURATION ---
+# 1. Your existing Master Schedule URL (The Map)
+MASTER_SHEET_URL = "https://docs.google.com/spreadsheets/d/1azbcaaIgw7K_MGZJfYdaX4mTvsYBx48ApdQ0HM8mNdA/edit"
+LINKS_TAB_NAME = "AI_LINKS"
+MEMORY_SHEET_URL = "https://docs.google.com/spreadsheets/d/1DDxAADCvTUcvKdeTb76giFBLIa3Yb1XOeGievJ_cung/edit"
+STOCK_SHEET_URL = "https://docs.google.com/spreadsheets/d/1E2GQfGkxkdbz0RmbbPcaIrMzmkJLC3MlNbGr4FT6FvM/edit?gid=2110353921#gid=2110353921"
+
+LOGS_TAB_NAME = "CHAT_LOGS"
+REF_DATA_TAB_NAME = "Ref_Data"
+
+# 2. Models
+GEMINI_MODEL_NAME = 'models/gemini-2.0-flash'
+EMBEDDING_MODEL = 'models/text-embedding-004'
+GENERATION_CONFIG = {'temperature': 0.2}
+
+# 3. Chat memory - local store; the memory sheet is kept in sync from a background thread
+MEMORY_DB_PATH = "hub_bot.db"
+SYNC_BATCH_ROWS = 20
+SYNC_INTERVAL_SECONDS = 30
+# Rows held for retry while the sheet is unreachable; the oldest beyond this are dropped
+SYNC_MAX_PENDING_ROWS = 500
+# Rows waiting for the sync thread; beyond this a message is kept locally only
+SYNC_QUEUE_SIZE = 1000
+SIDEBAR_SESSION_LIMIT = 10
+# Older messages are only re-rendered on request
+HISTORY_RENDER_LIMIT = 20
+# Earlier messages passed to the model as conversation context
+CONTEXT_MESSAGES = 3
+
+# 4. Cache lifetimes (seconds). AI_LINKS rarely changes; task tabs change slower than project data
+MAP_CACHE_TTL = 600
+TASKS_CACHE_TTL = 300
+SHEET_CACHE_TTL = 120
+TAB_TITLES_CACHE_TTL = 600
+SESSIONS_CACHE_TTL = 300
+# Rows fetched per tab; sent as the A1 range ('Tab'!1:N) so Sheets trims server-side
+TARGET_SHEET_MAX_ROWS = 300
+TASK_TAB_MAX_ROWS = 100
+# Threads for concurrent sheet reads, and the keep-alive Sheets connections they share
+READ_WORKERS = 8
+HTTP_POOL_SIZE = 16
+# Per-request deadline for Sheets calls, and tries for 408/429/5xx (backoff 1s, 2s, ...)
+SHEETS_TIMEOUT_SECONDS = 20
+SHEETS_ATTEMPTS = 3
+# Answers reused for repeat questions about the same project (shared across sessions)
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_MIN_KEYWORDS = 3
+
+# 5. Routing
+# Similarity needed for a near-miss project name to skip the LLM router
+FUZZY_MATCH_CUTOFF = 0.85
+# Speculative sheet reads started during the router call
+PREFETCH_TTL_SECONDS = 60
+PREFETCH_TOP_K = 2
+ROUTE_HISTORY_SIZE = 200
+# A prefetch candidate this far ahead of the runner-up is used without asking the router
+CONFIDENT_ROUTE_SCORE = 2
+# Words that send a prompt straight to the task tabs / stock sheet (only when exactly one side matches)
+TASK_ROUTE_KEYWORDS = ("task", "schedule", "people", "assignee")
+STOCK_ROUTE_KEYWORDS = ("stock", "inventory", "wood", "sheet count")
+# Local semantic routing: embeddings of the AI_LINKS rows vs the prompt
+EMBED_ROUTE_THRESHOLD = 0.6
+# ...and this far ahead of the best other sheet ("Smith - Drawings" vs "Jones - Drawings" goes to the router)
+EMBED_ROUTE_MARGIN = 0.05
+# After a failed embedding call the embedding router is skipped for this long
+EMBED_BACKOFF_SECONDS = 60
+# Structured output for the router - constrained decoding, always parseable
+ROUTER_GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': {
+        'type': 'object',
+        'properties': {
+            'url': {'type': 'string'},
+            'reason': {'type': 'string'},
+            'category': {'type': 'string'},
+        },
+        'required': ['url'],
+    },
+}
+
+# 6. Gemini calls
+# Request deadlines; a call that times out is retried once
+ROUTER_TIMEOUT_SECONDS = 8
+ANSWER_TIMEOUT_SECONDS = 30
+LLM_ATTEMPTS = 2
+# Streamed tokens are pushed to the UI at most this often
+STREAM_FLUSH_SECONDS = 0.05
+# Sheet data sent to Gemini is packed into this budget, most relevant tabs first
+MAX_CONTEXT_TOKENS = 12000
+MIN_TAB_TOKENS = 300
+CHARS_PER_TOKEN = 4  # Fallback if count_tokens calibration fails
+CALIBRATION_SAMPLE_CHARS = 2000
+# Explicit context caching of the Path A estimation data (needs a pinned model version)
+CONTEXT_CACHE_MODEL = 'models/gemini-2.0-flash-001'
+CONTEXT_CACHE_TTL_SECONDS = 600
+CONTEXT_CACHE_MIN_TOKENS = 4096